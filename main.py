@@ -1,38 +1,94 @@
 import streamlit as st
+import asyncio
+import json
 import sqlite3
 import re
+import threading
 import os
-from langchain_groq import ChatGroq
-from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
-from datetime import datetime
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
-# Initialize LLM
-llm = ChatGroq(
-    groq_api_key=os.getenv("GROQ_API_KEY"),
-    model="deepseek-r1-distill-llama-70b",
-    temperature=0.7,
-)
+# Initialize LLM (cached so the client and its keep-alive HTTP/2 connections are reused across reruns;
+# LangChain/Groq/httpx are imported here so the setup stage renders without loading them)
+@st.cache_resource
+def get_llm():
+    import httpx
+    from langchain_groq import ChatGroq
+
+    client = httpx.AsyncClient(
+        http2=True,
+        timeout=30.0,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+    )
+    return ChatGroq(
+        groq_api_key=os.getenv("GROQ_API_KEY"),
+        model="deepseek-r1-distill-llama-70b",
+        temperature=0.7,
+        max_retries=0,  # retries are handled by _aopen_stream
+        http_async_client=client,
+    )
+
+@st.cache_resource
+def get_loop():
+    """Run one event loop per process so the cached async client stays bound to it."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
 
 # Database utility
-def init_db():
-    conn = sqlite3.connect("language_mistakes.db")
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS mistakes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_input TEXT,
-            mistake TEXT,
-            correction TEXT,
-            timestamp TEXT
-        )
-    ''')
-    conn.commit()
+SCHEMA_SQL = '''
+    CREATE TABLE IF NOT EXISTS mistakes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_input TEXT,
+        mistake TEXT,
+        correction TEXT,
+        timestamp TEXT DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now'))
+    );
+    CREATE INDEX IF NOT EXISTS idx_mistakes_ts ON mistakes(timestamp);
+'''
+
+@st.cache_resource
+def get_conn():
+    """Open the single pooled connection; the schema DDL runs only here, once per process.
+
+    Callers share this connection and must not close it.
+    """
+    conn = sqlite3.connect("language_mistakes.db", check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-8000")
+    conn.execute("PRAGMA mmap_size=134217728")
+    conn.executescript(SCHEMA_SQL)
     return conn
 
+# The timestamp is computed by SQLite; spelled out so databases created before the column default still get one
+INSERT_MISTAKE_SQL = "INSERT INTO mistakes (user_input, mistake, correction, timestamp) VALUES (?, ?, ?, strftime('%Y-%m-%dT%H:%M:%S', 'now'))"
+MISTAKE_FLUSH_SIZE = 10
+
+@st.cache_resource
+def get_write_lock():
+    """Serialize transactions on the shared connection across sessions."""
+    return threading.Lock()
+
+def flush_mistakes(conn, pending):
+    """Write queued mistakes in a single transaction."""
+    if not pending:
+        return
+    with get_write_lock():
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(INSERT_MISTAKE_SQL, pending)
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+    pending.clear()
+
 # Scene options
 SCENES = {
     "Beginner": [
@@ -51,75 +107,260 @@ SCENES = {
         "You’re giving a presentation at work."
     ]
 }
+_LEVELS = tuple(SCENES)
+_LEVEL_INDEX = {level: i for i, level in enumerate(_LEVELS)}
 
-# Prompt templates
-CORRECTION_PROMPT = PromptTemplate(
-    input_variables=["input", "target", "native", "scene"],
-    template=(
-        "The user said: '{input}' in {target}.\n"
-        "Correct any mistakes WITHOUT changing the writing system (Latin, Cyrillic, Devanagari, etc).\n"
-        "Make corrections based on the context: {scene}.\n"
-        "If correct, reply exactly 'Correct!'.\n"
-        "Briefly explain corrections in {native}."
-    )
+# Prompt template
+COMBINED_TEMPLATE = (
+    "You are a conversation partner in this scene: {scene}.\n"
+    "The user said: '{input}' in {target_lang}.\n"
+    "Reply ONLY with a JSON object with exactly these keys:\n"
+    "\"reply\": your response to the user in {target_lang}, staying consistent with the scene and using the same writing system as the input;\n"
+    "\"correction\": the user's sentence with any mistakes corrected WITHOUT changing the writing system (Latin, Cyrillic, Devanagari, etc), or an empty string if it is correct;\n"
+    "\"explanation\": a brief explanation of the corrections in {native_lang}, or exactly 'Correct!' if there were none."
 )
 
-RESPONSE_PROMPT = PromptTemplate(
-    input_variables=["scene", "input", "target_lang"],
-    template=(
-        "Generate a response to '{input}' in '{target_lang}', staying consistent with the scene: {scene}.\n"
-        "Use the same writing system as the input."
-    )
-)
+@st.cache_resource
+def get_chain():
+    """Build the combined reply/correction chain once per process."""
+    from langchain.prompts import PromptTemplate
+    from langchain_core.output_parsers import StrOutputParser
+
+    prompt = PromptTemplate(input_variables=["input", "scene", "target_lang", "native_lang"], template=COMBINED_TEMPLATE)
+    return prompt | get_llm() | StrOutputParser()
 
 # Utility functions
+_THINK_RE = re.compile(r"<think>.*?</think>", re.DOTALL)
+_JSON_RE = re.compile(r"\{.*\}", re.DOTALL)
+_CORR_RE = re.compile(r"Corrected to:\s*(?P<c>[^.\n]+)")
+
 def clean_response(text):
     """Remove <think> tags."""
-    return re.sub(r"<think>.*?</think>", "", text, flags=re.DOTALL).strip()
+    if "<think>" not in text:
+        return text.strip()
+    return _THINK_RE.sub("", text).strip()
 
-def correct_input(user_input, target_lang, native_lang, scene, conn):
-    chain = LLMChain(llm=llm, prompt=CORRECTION_PROMPT)
-    response = chain.run(input=user_input, target=target_lang, native=native_lang, scene=scene)
-    
-    if "Correct!" not in response:
-        try:
-            correction = response.split("Corrected to:")[1].split(".")[0].strip()
-        except (IndexError, AttributeError):
-            correction = "Parsing error - check LLM output."
-        
-        conn.execute(
-            "INSERT INTO mistakes (user_input, mistake, correction, timestamp) VALUES (?, ?, ?, ?)",
-            (user_input, user_input, correction, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+def _extract_field(text, name):
+    """Pull one string field out of malformed JSON, or None if it can't be read."""
+    match = re.search(rf'"{name}"\s*:\s*"', text)
+    if not match:
+        return None
+    try:
+        value, _, closed = _scan_json_string(text, match.end())
+    except ValueError:
+        return None
+    return value.strip() if closed else None
+
+def parse_turn(text):
+    """Split the combined LLM output into (reply, correction, explanation, ok).
+
+    ok is False when the output was not valid JSON and had to be recovered leniently.
+    """
+    text = clean_response(text)
+    match = _JSON_RE.search(text)
+    try:
+        data = json.loads(match.group(0) if match else text, strict=False)
+    except ValueError:
+        data = None
+    if isinstance(data, dict):
+        return (
+            str(data.get("reply") or "").strip(),
+            str(data.get("correction") or "").strip(),
+            str(data.get("explanation") or "").strip(),
+            True,
         )
-        conn.commit()
-    
-    return clean_response(response)
+    reply = _extract_field(text, "reply")
+    if reply is not None:
+        return reply, _extract_field(text, "correction") or "", _extract_field(text, "explanation") or "", False
+    match = _CORR_RE.search(text)
+    correction = match.group("c").strip() if match else ""
+    return text, correction, "Parsing error - check LLM output.", False
 
-def generate_response(user_input, target_lang, scene):
-    chain = LLMChain(llm=llm, prompt=RESPONSE_PROMPT)
-    return clean_response(chain.run(scene=scene, input=user_input, target_lang=target_lang))
+_REPLY_START_RE = re.compile(r'"reply"\s*:\s*"')
+_DONE = object()
+
+MAX_CONCURRENCY = 8
+
+@st.cache_resource
+def get_semaphore():
+    """Cap in-flight Groq calls across all sessions."""
+    return asyncio.Semaphore(MAX_CONCURRENCY)
+
+async def _anext(agen):
+    return await anext(agen, _DONE)
+
+def iter_async(agen):
+    """Drive an async generator on the shared loop from the script thread."""
+    loop = get_loop()
+    try:
+        while (item := asyncio.run_coroutine_threadsafe(_anext(agen), loop).result()) is not _DONE:
+            yield item
+    finally:
+        asyncio.run_coroutine_threadsafe(agen.aclose(), loop).result()
+
+_JSON_ESCAPES = frozenset('"\\/bfnrtu')
+
+def _loads_json_string(raw):
+    """Decode a JSON string body, dropping the backslash from escapes JSON does not allow (e.g. \\')."""
+    try:
+        return json.loads(f'"{raw}"', strict=False)
+    except ValueError:
+        raw = re.sub(r"\\(.)", lambda m: m.group(0) if m.group(1) in _JSON_ESCAPES else m.group(1), raw, flags=re.DOTALL)
+        return json.loads(f'"{raw}"', strict=False)
+
+def _scan_json_string(text, pos):
+    """Return (decoded, next_pos, closed) for the complete part of a JSON string body starting at pos."""
+    i = pos
+    while i < len(text):
+        char = text[i]
+        if char == '"':
+            return _loads_json_string(text[pos:i]), i + 1, True
+        if char == "\\":
+            # Wait for the whole escape (and both halves of a surrogate pair)
+            size = 6 if text[i + 1:i + 2] == "u" else 2
+            if size == 6 and text[i + 2:i + 4].lower() in ("d8", "d9", "da", "db"):
+                size = 12
+            if i + size > len(text):
+                break
+            i += size
+        else:
+            i += 1
+    return _loads_json_string(text[pos:i]), i, False
+
+def _is_retryable(exc):
+    """Transient Groq failures: rate limits, connection errors/timeouts and 5xx responses."""
+    from groq import APIConnectionError, InternalServerError, RateLimitError
+    return isinstance(exc, (RateLimitError, APIConnectionError, InternalServerError))
+
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_random_exponential(multiplier=0.5, max=5),
+    retry=retry_if_exception(_is_retryable),
+    reraise=True,
+)
+async def _aopen_stream(chain, inputs, semaphore):
+    """Start streaming and wait for the first chunk, so transient errors are retried before anything is shown.
+
+    A semaphore slot is taken per attempt (never held during backoff) and stays
+    held by the returned stream; the caller releases it once streaming ends.
+    """
+    await semaphore.acquire()
+    stream = chain.astream(inputs)
+    try:
+        first = await anext(stream, "")
+    except BaseException:
+        await stream.aclose()
+        semaphore.release()
+        raise
+    return first, stream
+
+async def _prepend(first, stream):
+    yield first
+    async for chunk in stream:
+        yield chunk
+
+async def astream_reply(chain, inputs, turn, semaphore):
+    """Yield the "reply" field while the combined output streams in, then store the parsed turn."""
+    buffer, pos, closed, shown = "", None, False, []
+    first, stream = await _aopen_stream(chain, inputs, semaphore)
+    try:
+        async for chunk in _prepend(first, stream):
+            buffer += chunk
+            if closed:
+                continue
+            body = buffer
+            if "<think>" in body:
+                end = body.find("</think>")
+                if end == -1:
+                    continue
+                body = body[end + len("</think>"):]
+            if pos is None:
+                match = _REPLY_START_RE.search(body)
+                if not match:
+                    continue
+                pos = match.end()
+            try:
+                text, pos, closed = _scan_json_string(body, pos)
+            except ValueError:
+                # Undecodable escape: stop showing partial text and let parse_turn decide
+                closed = True
+                continue
+            if text:
+                shown.append(text)
+                yield text
+    finally:
+        await stream.aclose()
+        semaphore.release()
+
+    reply, correction, explanation, ok = parse_turn(buffer)
+    if shown and not ok:
+        # Keep the reply the user actually saw rather than a lenient re-parse
+        reply = "".join(shown).strip()
+    turn["parsed"], turn["ok"] = (reply, correction, explanation), ok
+    if not shown:
+        yield reply
+
+def respond(user_input, target_lang, native_lang, scene, pending, cache):
+    """Render the bot reply for one turn, streaming it unless cached, and return (reply, feedback)."""
+    # Only an exact repeat (up to whitespace) may reuse a turn: a near-identical
+    # sentence can differ by exactly the mistake that needs correcting
+    text = " ".join(user_input.split())
+    key = (scene, target_lang, native_lang, text)
+    hit = cache.get(key)
+    with st.chat_message("assistant", avatar=_AVATARS["assistant"]):
+        if hit:
+            reply, correction, explanation = hit
+            st.markdown(reply)
+        else:
+            turn = {}
+            inputs = {"input": user_input, "scene": scene, "target_lang": target_lang, "native_lang": native_lang}
+            st.write_stream(iter_async(astream_reply(st.session_state.chain, inputs, turn, get_semaphore())))
+            reply, correction, explanation = turn["parsed"]
+            if turn["ok"]:
+                cache[key] = (reply, correction, explanation)
+
+    if correction and correction != text:
+        pending.append((user_input, user_input, correction))
+        feedback = f"{explanation}\n\n**Corrected to:** {correction}"
+    else:
+        feedback = explanation or "Correct!"
+
+    return reply, feedback
+
+REVIEW_LIMIT = 200
 
 def review_mistakes(conn):
     cursor = conn.cursor()
-    cursor.execute("SELECT user_input, mistake, correction FROM mistakes")
+    cursor.arraysize = 256
+    cursor.execute("SELECT user_input, mistake, correction FROM mistakes ORDER BY id DESC LIMIT ?", (REVIEW_LIMIT,))
     rows = cursor.fetchall()
     
     if not rows:
         return "🎉 No mistakes recorded. Excellent work!"
     
-    review = "📝 **Mistake Review:**\n\n"
+    parts = ["📝 **Mistake Review:**", ""]
     for idx, (user_input, mistake, correction) in enumerate(rows, 1):
-        review += f"{idx}. **You said:** '{user_input}'\n   **Mistake:** '{mistake}' ➔ **Correction:** '{correction}'\n\n"
+        parts.append(f"{idx}. **You said:** '{user_input}'\n   **Mistake:** '{mistake}' ➔ **Correction:** '{correction}'")
+        parts.append("")
     
-    focus = "**Focus Area:** Verb conjugation and vocabulary improvement." if len(rows) > 2 else "**Focus Area:** Keep practicing!"
-    return review + "\n\n" + focus
+    parts.append("**Focus Area:** Verb conjugation and vocabulary improvement." if len(rows) > 2 else "**Focus Area:** Keep practicing!")
+    return "\n".join(parts)
+
+_AVATARS = {"scene": "🎯", "user": "🧑‍🎓", "assistant": "🤖", "feedback": "📝"}
+
+def render_message(role, text):
+    with st.chat_message(role, avatar=_AVATARS.get(role)):
+        st.markdown(text)
 
 # Main App
 def main():
     st.set_page_config(page_title="Language Learning Buddy", page_icon="🗣️")
     st.title("🗣️ Language Learning Chatbot")
 
-    conn = init_db()
+    # Attach the shared connection to the session once; reruns reuse it from here
+    if "conn" not in st.session_state:
+        st.session_state.conn = get_conn()
+    conn = st.session_state.conn
 
     if "stage" not in st.session_state:
         st.session_state.update({
@@ -129,6 +370,8 @@ def main():
             "native_lang": "",
             "level": "",
             "scene": "",
+            "pending_mistakes": [],
+            "cache": {},
         })
 
     stage = st.session_state.stage
@@ -138,7 +381,7 @@ def main():
             st.subheader("Let's get started!")
             st.session_state.target_lang = st.text_input("Language you want to learn:", value=st.session_state.target_lang)
             st.session_state.native_lang = st.text_input("Language you know:", value=st.session_state.native_lang)
-            st.session_state.level = st.selectbox("Your current level:", list(SCENES.keys()), index=list(SCENES.keys()).index(st.session_state.level) if st.session_state.level else 0)
+            st.session_state.level = st.selectbox("Your current level:", _LEVELS, index=_LEVEL_INDEX.get(st.session_state.level, 0))
             if st.form_submit_button("Next"):
                 if all([st.session_state.target_lang, st.session_state.native_lang, st.session_state.level]):
                     st.session_state.stage = "scene_selection"
@@ -153,31 +396,37 @@ def main():
             st.session_state.scene = st.selectbox("Pick a Scene:", scenes)
             if st.form_submit_button("Start Chatting"):
                 st.session_state.stage = "chat"
-                st.session_state.chat_history.append(f"**Scene:** {st.session_state.scene}")
+                st.session_state.chat_history.append(("scene", f"**Scene:** {st.session_state.scene}"))
                 st.rerun()
 
     elif stage == "chat":
+        # The chain (and LangChain itself) is only loaded once chatting starts
+        if "chain" not in st.session_state:
+            st.session_state.chain = get_chain()
         st.subheader(f"🎯 Scene: {st.session_state.scene}")
         st.markdown(f"✍️ Practice speaking in **{st.session_state.target_lang}**. (Type **'exit'** to finish.)")
         
-        for msg in st.session_state.chat_history:
-            st.markdown(msg)
+        history = st.container()
+        with history:
+            for role, text in st.session_state.chat_history:
+                render_message(role, text)
         
         with st.form("chat_form", clear_on_submit=True):
             user_input = st.text_input("You:")
             if st.form_submit_button("Send") and user_input:
                 if user_input.lower() == "exit":
+                    flush_mistakes(conn, st.session_state.pending_mistakes)
                     st.session_state.stage = "review"
                     st.rerun()
                 else:
-                    bot_response = generate_response(user_input, st.session_state.target_lang, st.session_state.scene)
-                    feedback = correct_input(user_input, st.session_state.target_lang, st.session_state.native_lang, st.session_state.scene, conn)
-                    st.session_state.chat_history.extend([
-                        f"🧑‍🎓 **You:** {user_input}",
-                        f"🤖 **Bot:** {bot_response}",
-                        f"📝 **Feedback:** {feedback}"
-                    ])
-                    st.rerun()
+                    # Render only the new turn instead of rerunning the whole transcript
+                    with history:
+                        render_message("user", user_input)
+                        bot_response, feedback = respond(user_input, st.session_state.target_lang, st.session_state.native_lang, st.session_state.scene, st.session_state.pending_mistakes, st.session_state.cache)
+                        render_message("feedback", feedback)
+                    st.session_state.chat_history.extend([("user", user_input), ("assistant", bot_response), ("feedback", feedback)])
+                    if len(st.session_state.pending_mistakes) >= MISTAKE_FLUSH_SIZE:
+                        flush_mistakes(conn, st.session_state.pending_mistakes)
 
     elif stage == "review":
         st.success("✅ Chat ended. Here's your review:")
@@ -186,7 +435,5 @@ def main():
             st.session_state.clear()
             st.rerun()
 
-    conn.close()
-
 if __name__ == "__main__":
     main()
@@ -0,0 +1,95 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from main import SCHEMA_SQL, astream_reply, flush_mistakes
+
+
+class FakeChain:
+    """Stand-in for the LCEL chain that streams fixed text in small chunks."""
+
+    def __init__(self, text, size):
+        self.text = text
+        self.size = size
+
+        self.closed = False
+
+    async def astream(self, inputs):
+        try:
+            for i in range(0, len(self.text), self.size):
+                yield self.text[i:i + self.size]
+        finally:
+            self.closed = True
+
+
+def stream_turn(text, size=3):
+    async def run():
+        turn = {}
+        pieces = [piece async for piece in astream_reply(FakeChain(text, size), {}, turn, asyncio.Semaphore(1))]
+        return "".join(pieces), turn
+
+    return asyncio.run(run())
+
+
+def test_streams_reply_after_think_block():
+    shown, turn = stream_turn('<think>"reply": "no"</think>{"reply": "Hola", "correction": "", "explanation": "Correct!"}')
+    assert shown == "Hola"
+    assert turn["parsed"] == ("Hola", "", "Correct!")
+    assert turn["ok"]
+
+
+def test_unicode_escape_split_across_chunks():
+    for size in (1, 2, 5):
+        shown, _ = stream_turn('{"reply": "caf\\u00e9 \\ud83d\\ude00", "correction": "", "explanation": ""}', size)
+        assert shown == "café 😀"
+
+
+def test_invalid_apostrophe_escape_does_not_crash():
+    shown, turn = stream_turn('{"reply": "C\\\'est bien", "correction": "", "explanation": "Correct!"}')
+    assert shown == "C'est bien"
+    assert turn["parsed"] == ("C'est bien", "", "Correct!")
+
+
+def test_undecodable_escape_stops_streaming_without_crashing():
+    shown, turn = stream_turn('{"reply": "ok \\uZZZZ", "correction": "", "explanation": ""}')
+    assert shown == "ok "
+    assert turn["parsed"][0] == "ok"
+    assert not turn["ok"]
+
+
+def test_malformed_json_keeps_streamed_reply_and_correction():
+    shown, turn = stream_turn('{"reply": "Aquí tienes.", "correction": "Quiero dos manzanas.", "explanation": "plural",}')
+    assert shown == "Aquí tienes."
+    assert turn["parsed"] == ("Aquí tienes.", "Quiero dos manzanas.", "plural")
+    assert not turn["ok"]
+
+
+def test_stopping_early_closes_stream_and_frees_slot():
+    async def run():
+        chain, semaphore = FakeChain('{"reply": "Hola amigo", "correction": "", "explanation": ""}', 3), asyncio.Semaphore(1)
+        stream = astream_reply(chain, {}, {}, semaphore)
+        await anext(stream)
+        await stream.aclose()
+        return chain.closed, semaphore.locked()
+
+    assert asyncio.run(run()) == (True, False)
+
+
+def test_failed_commit_rolls_back_and_later_flush_succeeds(tmp_path):
+    path = tmp_path / "mistakes.db"
+    conn = sqlite3.connect(path, isolation_level=None, timeout=0)
+    conn.executescript(SCHEMA_SQL)
+    reader = sqlite3.connect(path, isolation_level=None)
+    reader.execute("BEGIN")
+    reader.execute("SELECT * FROM mistakes").fetchall()
+
+    with pytest.raises(sqlite3.OperationalError):
+        flush_mistakes(conn, [("yo ir", "yo ir", "yo voy")])
+    assert not conn.in_transaction
+
+    reader.execute("COMMIT")
+    pending = [("yo ir", "yo ir", "yo voy")]
+    flush_mistakes(conn, pending)
+    assert pending == []
+    assert conn.execute("SELECT COUNT(*) FROM mistakes").fetchone() == (1,)